@@ -1,5 +1,6 @@
 import pandas as pd
 import json
+import csv
 import os
 from dotenv import load_dotenv
 from brain_api import BrainClient
@@ -9,10 +10,13 @@ import time
 # Load environment variables from .env file
 load_dotenv()
 
+# Columns used by process_keywords; everything else is skipped at load time
+CSV_COLUMNS = ['Keyword', 'Reason-to_Flag', 'Country_Code']
+
 def load_csv_data(filename):
     """Load data from CSV file using pandas"""
     try:
-        df = pd.read_csv(filename)
+        df = pd.read_csv(filename, usecols=CSV_COLUMNS, dtype=str)
         return df
     except Exception as e:
         print(f"Error loading CSV file: {e}")
@@ -24,12 +28,12 @@ def process_keywords(df):
     country_keywords = defaultdict(list)
     global_keywords = []
     
-    # Process each row
-    for _, row in df.iterrows():
-        keyword = str(row['Keyword']).strip()
-        reason = str(row['Reason-to_Flag']).strip()
-        country_code = str(row['Country_Code']).strip()
-        
+    # Normalize the needed columns once instead of per row
+    keywords = df['Keyword'].astype(str).str.strip().to_numpy()
+    reasons = df['Reason-to_Flag'].astype(str).str.strip().to_numpy()
+    country_codes = df['Country_Code'].astype(str).str.strip().to_numpy()
+    
+    for keyword, reason, country_code in zip(keywords, reasons, country_codes):
         # Skip empty keywords
         if not keyword:
             continue
@@ -49,6 +53,13 @@ def process_keywords(df):
     
     return country_keywords, global_keywords
 
+def write_keywords_csv(filename, keywords):
+    """Write keyword entries to a CSV file"""
+    with open(filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['keyword', 'reason'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(keywords)
+
 def save_results(country_keywords, global_keywords):
     """Save results to JSON and CSV files"""
     # Save country-specific keywords to JSON
@@ -61,12 +72,10 @@ def save_results(country_keywords, global_keywords):
     
     # Create and save country-specific CSV files
     for country_code, keywords in country_keywords.items():
-        df = pd.DataFrame(keywords)
-        df.to_csv(f'keywords_{country_code}.csv', index=False)
+        write_keywords_csv(f'keywords_{country_code}.csv', keywords)
     
     # Create and save global keywords CSV
-    global_df = pd.DataFrame(global_keywords)
-    global_df.to_csv('keywords_ALL.csv', index=False)
+    write_keywords_csv('keywords_ALL.csv', global_keywords)
 
 def main():
     # Initialize Brain API client
@@ -1,145 +1,291 @@
 import pandas as pd
 import json
 import os
+import argparse
+import hashlib
+import importlib.metadata
+import sqlite3
+import random
+import threading
 from dotenv import load_dotenv
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Optional, Tuple
 import concurrent.futures
 import time
+import requests
 from pydantic import BaseModel
 from brain_platform_client.brain_api import BrainApi
 
 # Load environment variables
 load_dotenv()
 
+# Input CSV columns mapped to the keys used in batch prompts
+INPUT_COLUMNS = {
+    'Keyword': 'keyword',
+    'Reason_to_Flag': 'reason',
+    'Country_Code': 'country_code',
+    'Valid_Country_Codes': 'valid_country_codes',
+    'Country': 'country',
+    'Compliance _Region': 'compliance_region',
+}
+
+# Timeouts and dropped connections are worth retrying; rate limits and server
+# errors are recognized by their HTTP status in is_transient_error
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+# openai's timeout and connection errors, raised through brain-platform-client;
+# matched by class name so openai need not be imported directly
+TRANSIENT_ERROR_NAMES = {'APITimeoutError', 'APIConnectionError'}
+
+def is_transient_error(error: Exception) -> bool:
+    """Check whether a failed API call may succeed if retried"""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code == 429 or (isinstance(status_code, int) and status_code >= 500)
+
 class KeywordAnalysis(BaseModel):
-    """Pydantic model for structured keyword analysis response"""
+    """Pydantic schema requested as the structured keyword analysis response"""
     analyses: List[Dict[str, str]]
 
+# Static instructions kept at the start of every batch prompt so the provider
+# can reuse its cached prefix; only the keyword list varies per call
+BATCH_PROMPT_PREFIX = (
+    "Briefly analyze why each keyword below was flagged (1-2 sentences each).\n"
+    'Respond only with JSON: {"analyses": [{"keyword": "...", "analysis": "..."}]}\n\n'
+)
+
+# Optional per-keyword fields included in batch prompts when present, in order
+OPTIONAL_PROMPT_FIELDS = (
+    ('valid_country_codes', 'Valid Country Codes'),
+    ('country', 'Country'),
+    ('compliance_region', 'Compliance Region'),
+    ('country_code', 'Country Code'),
+)
+
+# Bump to invalidate cached analyses, e.g. after switching the model BrainApi uses
+CACHE_VERSION = 1
+
+def brain_client_version() -> str:
+    """Installed brain-platform-client version; its upgrades can change the default model"""
+    try:
+        return importlib.metadata.version('brain-platform-client')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+class ResponseCache:
+    """SQLite-backed cache of per-keyword analyses returned by the LLM"""
+
+    def __init__(self, path: str = '.llm_cache.sqlite'):
+        self._namespace = [CACHE_VERSION, brain_client_version(), BATCH_PROMPT_PREFIX]
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, analysis TEXT NOT NULL)"
+            )
+            self._conn.commit()
+
+    def make_key(self, keyword_data: Dict) -> str:
+        """Hash the cache version, client version, prompt instructions and one keyword's fields"""
+        payload = json.dumps([*self._namespace, keyword_data], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.blake2b(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Return the cached analyses for the given keys, omitting misses"""
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self._conn.execute(
+                    f"SELECT key, analysis FROM analyses WHERE key IN ({placeholders})", chunk
+                ).fetchall())
+        return found
+
+    def set_many(self, analyses: Dict[str, str]):
+        """Store analyses keyed by cache key"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO analyses (key, analysis) VALUES (?, ?)",
+                analyses.items(),
+            )
+            self._conn.commit()
+
 class KeywordProcessor:
-    def __init__(self):
+    def __init__(self, use_cache: bool = True, max_workers: int = 8):
         self.brain_api = BrainApi()
-        self.batch_size = 10  # Process 10 keywords per API call
+        self.batch_size = 30  # At most 30 keywords per API call
+        self.max_prompt_chars = 12000  # Roughly 3000 input tokens per API call
         self.max_retries = 3
+        self.max_workers = max_workers  # Concurrent API calls; lower if rate limited
+        self.cache = ResponseCache() if use_cache else None
 
     def read_keywords(self, file_path: str) -> pd.DataFrame:
-        """Read the keywords CSV file"""
-        return pd.read_csv(file_path)
+        """Read the keywords CSV file, parsing only the columns used downstream"""
+        return pd.read_csv(file_path, usecols=lambda column: column in INPUT_COLUMNS, dtype=str)
 
     def create_batch_prompt(self, keyword_data: List[Dict]) -> str:
         """Create a batch prompt for multiple keywords"""
-        prompt = "You are a helpful assistant that analyzes keywords and their reasons for flagging. Your task is to analyze each keyword and provide a brief analysis.\n\n"
-        prompt += "Keywords to analyze:\n\n"
+        parts = [BATCH_PROMPT_PREFIX]
         
         for i, data in enumerate(keyword_data, 1):
-            prompt += f"{i}. Keyword: {data['keyword']}\n"
-            prompt += f"   Reason: {data['reason']}\n"
-            if data.get('valid_country_codes'):
-                prompt += f"   Valid Country Codes: {data['valid_country_codes']}\n"
-            if data.get('country'):
-                prompt += f"   Country: {data['country']}\n"
-            if data.get('compliance_region'):
-                prompt += f"   Compliance Region: {data['compliance_region']}\n"
-            if data.get('country_code'):
-                prompt += f"   Country Code: {data['country_code']}\n"
-            prompt += "\n"
-        
-        prompt += "Respond with JSON in the following format:\n"
-        prompt += "{\n"
-        prompt += '  "analyses": [\n'
-        prompt += '    {"keyword": "keyword1", "analysis": "analysis text"},\n'
-        prompt += '    {"keyword": "keyword2", "analysis": "analysis text"}\n'
-        prompt += '  ]\n'
-        prompt += "}"
-        return prompt
-
-    def process_batch_with_brain_api(self, keyword_batch: List[Dict]) -> Dict[str, str]:
-        """Process a batch of keywords with Brain API using the new client"""
-        analyses = {}
+            parts.append(f"{i}. Keyword: {data['keyword']}\n")
+            parts.append(f"   Reason: {data['reason']}\n")
+            for key, label in OPTIONAL_PROMPT_FIELDS:
+                if data.get(key):
+                    parts.append(f"   {label}: {data[key]}\n")
+            parts.append("\n")
         
+        return ''.join(parts)
+
+    def invoke_with_retries(self, prompt: str, response_format: Any) -> Any:
+        """Call the LLM, retrying only transient failures with jittered backoff"""
         for attempt in range(self.max_retries):
             try:
-                prompt = self.create_batch_prompt(keyword_batch)
-                
-                print(f"Sending batch request for {len(keyword_batch)} keywords (attempt {attempt + 1})")
-                
-                # Use the new BrainApi client with structured output
-                response_payload = self.brain_api.invoke_llm(
+                return self.brain_api.invoke_llm(
                     prompt=prompt,
-                    response_format=KeywordAnalysis,
+                    response_format=response_format,
                 )
-                
-                # Parse the structured response
-                try:
-                    keyword_analysis = KeywordAnalysis.model_validate_json(response_payload.response)
-                    
-                    for analysis in keyword_analysis.analyses:
-                        keyword = analysis.get('keyword', '').strip()
-                        analysis_text = analysis.get('analysis', '')
-                        if keyword:
-                            analyses[keyword] = analysis_text
-                    
-                    print(f"Successfully processed batch of {len(keyword_analysis.analyses)} keywords")
-                    return analyses
-                    
-                except Exception as parse_error:
-                    print(f"Failed to parse structured response: {str(parse_error)}")
-                    # Fallback: try JSON mode
-                    response_payload = self.brain_api.invoke_llm(
-                        prompt=prompt,
-                        response_format="json_object",
-                    )
-                    
-                    parsed_response = json.loads(response_payload.response)
-                    if 'analyses' in parsed_response:
-                        for analysis in parsed_response['analyses']:
-                            keyword = analysis.get('keyword', '').strip()
-                            analysis_text = analysis.get('analysis', '')
-                            if keyword:
-                                analyses[keyword] = analysis_text
-                        print(f"Successfully processed batch with JSON fallback")
-                        return analyses
-                    else:
-                        print(f"JSON response missing 'analyses' key")
-                        for data in keyword_batch:
-                            analyses[data['keyword']] = "Analysis failed: Invalid response format"
-                        return analyses
-                
             except Exception as e:
-                print(f"Unexpected error on attempt {attempt + 1}: {str(e)}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
+                if not is_transient_error(e) or attempt == self.max_retries - 1:
+                    raise
+                delay = random.uniform(0, min(16, 2 ** (attempt + 1)))  # Full jitter
+                print(f"Transient error on attempt {attempt + 1}: {str(e)}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def parse_analyses(self, response_text: str) -> Optional[Dict[str, str]]:
+        """Map keywords to analyses from a JSON reply, or None if it has no analyses list"""
+        try:
+            parsed = json.loads(response_text)
+        except ValueError:
+            return None
+        if not isinstance(parsed, dict) or not isinstance(parsed.get('analyses'), list):
+            return None
+        
+        analyses = {}
+        for analysis in parsed['analyses']:
+            if not isinstance(analysis, dict):
+                continue
+            keyword = analysis.get('keyword')
+            analysis_text = analysis.get('analysis')
+            if isinstance(keyword, str) and keyword.strip() and isinstance(analysis_text, str):
+                analyses[keyword.strip()] = analysis_text
+        return analyses
+
+    def process_batch_with_brain_api(self, keyword_batch: List[Dict]) -> Dict[str, str]:
+        """Process a batch of keywords with Brain API using the new client"""
+        # Sort so batches with the same keywords produce the same prompt
+        keyword_batch = sorted(keyword_batch, key=lambda data: str(data['keyword']))
+        prompt = self.create_batch_prompt(keyword_batch)
+        
+        try:
+            print(f"Sending batch request for {len(keyword_batch)} keywords")
+            
+            # KeywordAnalysis is only the structured-output schema; the reply
+            # itself is parsed as plain JSON
+            response_payload = self.invoke_with_retries(prompt, KeywordAnalysis)
+            analyses = self.parse_analyses(response_payload.response)
+            
+            if analyses is None:
+                print("Structured response missing 'analyses'; falling back to JSON mode")
+                response_payload = self.invoke_with_retries(prompt, "json_object")
+                analyses = self.parse_analyses(response_payload.response)
+            
+            if analyses is None:
+                print(f"JSON response missing 'analyses' key")
+                return {data['keyword']: "Analysis failed: Invalid response format" for data in keyword_batch}
+            
+            print(f"Successfully processed batch of {len(analyses)} keywords")
+            if self.cache:
+                # Cache per keyword so keywords missing from a partial reply are retried next run
+                self.cache.set_many({
+                    self.cache.make_key(data): analyses[data['keyword']]
+                    for data in keyword_batch
+                    if data['keyword'] in analyses
+                })
+            return analyses
+            
+        except Exception as e:
+            print(f"Failed to process batch: {str(e)}")
         
-        # If all attempts failed, return empty analyses
-        print(f"Failed to process batch after {self.max_retries} attempts")
         return {data['keyword']: "Analysis failed" for data in keyword_batch}
 
+    def split_into_batches(self, keyword_data: List[Dict]) -> List[List[Dict]]:
+        """Greedily pack keywords into batches bounded by prompt size and keyword count"""
+        batches = []
+        current = []
+        used = len(BATCH_PROMPT_PREFIX)
+        
+        for data in keyword_data:
+            # Field values plus room for the labels added by create_batch_prompt
+            size = sum(len(str(value)) for value in data.values()) + 100
+            if current and (used + size > self.max_prompt_chars or len(current) >= self.batch_size):
+                batches.append(current)
+                current = []
+                used = len(BATCH_PROMPT_PREFIX)
+            current.append(data)
+            used += size
+        
+        if current:
+            batches.append(current)
+        return batches
+
     def process_keywords_in_batches(self, df: pd.DataFrame) -> Dict[str, str]:
         """Process all keywords in batches"""
         all_analyses = {}
         
-        # Prepare keyword data
-        keyword_data = []
-        for _, row in df.iterrows():
-            keyword_data.append({
-                'keyword': row['Keyword'],
-                'reason': row['Reason_to_Flag'],
-                'country_code': row.get('Country_Code', ''),
-                'valid_country_codes': row.get('Valid_Country_Codes', ''),
-                'country': row.get('Country', ''),
-                'compliance_region': row.get('Compliance _Region', '')
-            })
+        # Prepare keyword data from the needed columns in one pass
+        records = df.reindex(columns=list(INPUT_COLUMNS)).fillna('').to_dict(orient='records')
+        keyword_data = [
+            {key: record[column] for column, key in INPUT_COLUMNS.items()}
+            for record in records
+        ]
+        # Replies are keyed by the stripped keyword, so every lookup uses that form
+        for data in keyword_data:
+            data['keyword'] = str(data['keyword']).strip()
+        
+        # Analyze each keyword once; rows sharing a keyword reuse its analysis.
+        # Blank keywords have nothing to analyze, so they never reach the API.
+        unique_data = {}
+        for data in keyword_data:
+            if not data['keyword']:
+                continue
+            unique_data.setdefault(data['keyword'], data)
+        keyword_data = list(unique_data.values())
+        
+        # Reuse cached analyses and only send the remaining keywords to the API
+        if self.cache:
+            keys = [self.cache.make_key(data) for data in keyword_data]
+            cached = self.cache.get_many(keys)
+            pending = []
+            for data, key in zip(keyword_data, keys):
+                if key in cached:
+                    all_analyses[data['keyword']] = cached[key]
+                else:
+                    pending.append(data)
+            print(f"Reusing cached analyses for {len(all_analyses)} keywords")
+            keyword_data = pending
         
         # Split into batches
-        batches = [keyword_data[i:i + self.batch_size] 
-                  for i in range(0, len(keyword_data), self.batch_size)]
+        batches = self.split_into_batches(keyword_data)
         
-        print(f"Processing {len(keyword_data)} keywords in {len(batches)} batches")
+        print(f"Processing {len(keyword_data)} unique keywords ({len(records)} rows) in {len(batches)} batches")
         
         # Process batches with limited concurrency
         def process_single_batch(batch):
             return self.process_batch_with_brain_api(batch)
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             batch_results = list(executor.map(process_single_batch, batches))
         
         # Combine all results
@@ -150,60 +296,33 @@ class KeywordProcessor:
 
     def create_optimized_json_and_csv(self, df: pd.DataFrame, analyses: Dict[str, str]) -> Tuple[Dict, pd.DataFrame]:
         """Create both JSON and CSV structures with country headers"""
+        country_codes = df['Country_Code']
+        is_all = country_codes == 'ALL'
+        is_specific = country_codes.notna() & ~is_all
         
         # Get unique countries (excluding 'ALL' and NaN values)
-        countries = sorted([country for country in df['Country_Code'].unique() 
-                          if pd.notna(country) and country != 'ALL'])
-        
-        # Initialize simple JSON structure with country codes as keys
-        json_structure = {}
-        
-        # Initialize country sections in JSON with empty arrays
-        for country in countries:
-            json_structure[country] = []
+        countries = sorted(country_codes[is_specific].unique())
         
-        # Add special section for ALL countries
-        json_structure["ALL"] = []
+        # JSON: keywords per country code, with the special ALL section last
+        grouped = df.loc[is_specific].groupby('Country_Code', sort=False)['Keyword']
+        json_structure = {country: grouped.get_group(country).tolist() for country in countries}
+        json_structure["ALL"] = df.loc[is_all, 'Keyword'].tolist()
         
-        # Prepare CSV data
-        csv_data = []
+        # CSV: ALL rows first, then country-specific rows, each in input order
+        rows = pd.concat([df.loc[is_all], df.loc[is_specific]])
+        row_codes = rows['Country_Code']
+        row_is_all = row_codes == 'ALL'
         
-        # Process ALL countries keywords
-        all_countries_df = df[df['Country_Code'] == 'ALL']
-        for _, row in all_countries_df.iterrows():
-            keyword = row['Keyword']
-            reason = row['Reason_to_Flag']
-            analysis = analyses.get(keyword, "No analysis available")
-            
-            # Add keyword to ALL section in JSON
-            json_structure["ALL"].append(keyword)
-            
-            # For CSV, add to data with 'ALL' marked in all country columns
-            csv_row = {"Keyword": keyword, "Reason": reason, "Analysis": analysis}
-            for country in countries:
-                csv_row[country] = "ALL"
-            csv_data.append(csv_row)
-        
-        # Process country-specific keywords (excluding 'ALL' and NaN values)
-        country_specific_df = df[(df['Country_Code'] != 'ALL') & (pd.notna(df['Country_Code']))]
-        for _, row in country_specific_df.iterrows():
-            keyword = row['Keyword']
-            reason = row['Reason_to_Flag']
-            country = row['Country_Code']
-            analysis = analyses.get(keyword, "No analysis available")
-            
-            # Add keyword to specific country array in JSON
-            if country in json_structure:
-                json_structure[country].append(keyword)
-            
-            # For CSV, create row with country marked
-            csv_row = {"Keyword": keyword, "Reason": reason, "Analysis": analysis}
-            for c in countries:
-                csv_row[c] = "YES" if c == country else ""
-            csv_data.append(csv_row)
+        csv_columns = {
+            "Keyword": rows['Keyword'],
+            "Reason": rows['Reason_to_Flag'],
+            "Analysis": rows['Keyword'].str.strip().map(analyses).fillna("No analysis available"),
+        }
+        # 'ALL' rows are marked in every country column, others only in their own
+        for country in countries:
+            csv_columns[country] = (row_codes == country).map({True: "YES", False: ""}).mask(row_is_all, "ALL")
         
-        # Create DataFrame for CSV
-        csv_df = pd.DataFrame(csv_data)
+        csv_df = pd.DataFrame(csv_columns).reset_index(drop=True)
         
         return json_structure, csv_df
 
@@ -242,5 +361,12 @@ class KeywordProcessor:
         print(f"- Countries covered: {list(json_structure.keys())}")
 
 if __name__ == "__main__":
-    processor = KeywordProcessor()
+    parser = argparse.ArgumentParser(description="Analyze flagged keywords with Brain API")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Ignore and do not update the local LLM response cache")
+    parser.add_argument('--max-workers', type=int, default=8,
+                        help="Number of concurrent Brain API requests (default: 8)")
+    args = parser.parse_args()
+    
+    processor = KeywordProcessor(use_cache=not args.no_cache, max_workers=args.max_workers)
     processor.process_and_save('keywords.csv') 
\ No newline at end of file